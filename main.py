@@ -1,17 +1,37 @@
 # -*- coding: utf-8 -*-
 
+# gevent ワーカーで動かすため、他のモジュールより先にパッチを当てる
+from gevent import monkey
+monkey.patch_all()
+
 from flask import Flask, request, abort
 from linebot import LineBotApi, WebhookHandler
 from linebot.models import MessageEvent, TextMessage, TextSendMessage
 from linebot.exceptions import InvalidSignatureError
+from linebot.webhook import SignatureValidator
+from linebot.http_client import RequestsHttpClient, RequestsHttpResponse
+from requests.adapters import HTTPAdapter
+import requests
 from google.oauth2 import service_account
 from googleapiclient.discovery import build
+import google_auth_httplib2
+import httplib2
 from apscheduler.schedulers.background import BackgroundScheduler
 from datetime import datetime, timedelta
-from pytz import timezone
+from itertools import chain
+from concurrent.futures import ThreadPoolExecutor
+from zoneinfo import ZoneInfo
+from cachetools import TTLCache
+import threading
+import fcntl
+import queue
 import re
 import os
-import json
+import orjson
+import hmac
+import hashlib
+import base64
+import time
 
 app = Flask(__name__)
 
@@ -23,39 +43,130 @@ GOOGLE_CREDENTIALS_JSON = os.getenv("GOOGLE_CREDENTIALS_JSON")
 LINE_GROUP_ID = os.getenv("LINE_GROUP_ID")
 
 # LINE SDK
-line_bot_api = LineBotApi(LINE_CHANNEL_ACCESS_TOKEN)
+# 既定の RequestsHttpClient は呼び出しごとに接続を張り直すため、共有セッションで keep-alive する
+_line_session = requests.Session()
+_line_session.mount('https://', HTTPAdapter(pool_connections=16, pool_maxsize=64, max_retries=3))
+
+class SessionHttpClient(RequestsHttpClient):
+    def get(self, url, headers=None, params=None, stream=False, timeout=None):
+        response = _line_session.get(
+            url, headers=headers, params=params, stream=stream,
+            timeout=self.timeout if timeout is None else timeout
+        )
+        return RequestsHttpResponse(response)
+
+    def post(self, url, headers=None, data=None, timeout=None):
+        response = _line_session.post(
+            url, headers=headers, data=data,
+            timeout=self.timeout if timeout is None else timeout
+        )
+        return RequestsHttpResponse(response)
+
+    def delete(self, url, headers=None, data=None, timeout=None):
+        response = _line_session.delete(
+            url, headers=headers, data=data,
+            timeout=self.timeout if timeout is None else timeout
+        )
+        return RequestsHttpResponse(response)
+
+    def put(self, url, headers=None, data=None, timeout=None):
+        response = _line_session.put(
+            url, headers=headers, data=data,
+            timeout=self.timeout if timeout is None else timeout
+        )
+        return RequestsHttpResponse(response)
+
+line_bot_api = LineBotApi(LINE_CHANNEL_ACCESS_TOKEN, timeout=10, http_client=SessionHttpClient)
 handler = WebhookHandler(LINE_CHANNEL_SECRET)
 
+class BytesSignatureValidator(SignatureValidator):
+    """リクエストボディを bytes のまま署名検証する（str へのデコードと再エンコードを省く）"""
+
+    def validate(self, body, signature):
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        gen_signature = hmac.new(self.channel_secret, body, hashlib.sha256).digest()
+        return hmac.compare_digest(signature.encode('utf-8'), base64.b64encode(gen_signature))
+
+handler.parser.signature_validator = BytesSignatureValidator(LINE_CHANNEL_SECRET)
+
 # Google Calendar 認証
 SCOPES = ['https://www.googleapis.com/auth/calendar']
-credentials_info = json.loads(GOOGLE_CREDENTIALS_JSON)
+credentials_info = orjson.loads(GOOGLE_CREDENTIALS_JSON)
 creds = service_account.Credentials.from_service_account_info(credentials_info, scopes=SCOPES)
-calendar_service = build('calendar', 'v3', credentials=creds)
+calendar_service = build('calendar', 'v3', credentials=creds, cache_discovery=False)
+
+# httplib2.Http はスレッドセーフではないため、認証済み接続をプールして使い回す
+_http_pool = queue.LifoQueue()
 
-JST = timezone('Asia/Tokyo')
+def execute_request(req):
+    """プールした接続（keep-alive）で Calendar API リクエストを実行する"""
+    try:
+        http = _http_pool.get_nowait()
+    except queue.Empty:
+        http = google_auth_httplib2.AuthorizedHttp(creds, http=httplib2.Http(timeout=30))
+    try:
+        return req.execute(http=http)
+    finally:
+        _http_pool.put(http)
+
+JST = ZoneInfo('Asia/Tokyo')
+
+# 現在の年（1時間ごと、または年明けの時点で更新）
+_year_cache = (0, 0.0)
+
+def current_year():
+    global _year_cache
+    year, expiry = _year_cache
+    now = time.monotonic()
+    if now >= expiry:
+        today = datetime.now(JST)
+        year = today.year
+        next_year = today.replace(year=year + 1, month=1, day=1, hour=0, minute=0, second=0, microsecond=0)
+        _year_cache = (year, now + min(3600, (next_year - today).total_seconds()))
+    return year
+
+# 予定メッセージの各項目（順番は問わない）
+# 値は先読みで取り出すので、同じ行に続く見出しも取りこぼさない
+_FIELDS_RE = re.compile(r'【(タイトル|日付|開始時間|内容|URL)】(?=([^\n]*))')
+_FIELD_VALUE_RES = {
+    'タイトル': re.compile(r'[^\n]+'),
+    '日付': re.compile(r'(\d{1,2})[/-](\d{1,2})'),
+    '開始時間': re.compile(r'(\d{1,2}):(\d{2})'),
+    '内容': re.compile(r'[^\n]+'),
+    'URL': re.compile(r'[^\n]+'),
+}
 
 def extract_event_info(message):
-    title_match = re.search(r'【タイトル】(.+)', message)
-    date_match = re.search(r'【日付】(\d{1,2})[/-](\d{1,2})', message)
-    start_time_match = re.search(r'【開始時間】(\d{1,2}):(\d{2})', message)
-    content_match = re.search(r'【内容】(.+)', message)
-    url_match = re.search(r'【URL】(.+)', message)
+    # 1回の走査で全項目を集め、項目ごとに形式に合う最初の値を使う
+    found = {}
+    for m in _FIELDS_RE.finditer(message):
+        name = m.group(1)
+        if name not in found:
+            value_match = _FIELD_VALUE_RES[name].match(m.group(2))
+            if value_match:
+                found[name] = value_match
+
+    title_match = found.get('タイトル')
+    date_match = found.get('日付')
+    start_time_match = found.get('開始時間')
+    content_match = found.get('内容')
+    url_match = found.get('URL')
 
     if not (title_match and date_match and start_time_match):
         return None
 
-    title = title_match.group(1).strip()
+    title = title_match.group().strip()
     month = int(date_match.group(1))
     day = int(date_match.group(2))
     hour = int(start_time_match.group(1))
     minute = int(start_time_match.group(2))
 
-    content = content_match.group(1).strip() if content_match else ""
-    url = url_match.group(1).strip() if url_match else ""
+    content = content_match.group().strip() if content_match else ""
+    url = url_match.group().strip() if url_match else ""
 
-    year = datetime.now(JST).year
-    naive_dt = datetime(year, month, day, hour, minute)
-    dt = JST.localize(naive_dt)
+    year = current_year()
+    dt = datetime(year, month, day, hour, minute, tzinfo=JST)
     start_str = dt.isoformat()
     end_str = (dt + timedelta(hours=1)).isoformat()
 
@@ -65,6 +176,18 @@ def extract_event_info(message):
 
     return title, start_str, end_str, description
 
+# 予定一覧の短期キャッシュ（予定の登録・削除時にクリアする）
+_events_cache = TTLCache(maxsize=32, ttl=60)
+_events_cache_lock = threading.Lock()
+# クリアのたびに増やし、クリア前に始まった取得結果を書き戻さないようにする
+_events_cache_generation = 0
+
+def clear_events_cache():
+    global _events_cache_generation
+    with _events_cache_lock:
+        _events_cache.clear()
+        _events_cache_generation += 1
+
 def add_event(summary, start_time_str, end_time_str, description=None):
     event = {
         'summary': summary,
@@ -73,57 +196,85 @@ def add_event(summary, start_time_str, end_time_str, description=None):
     }
     if description:
         event['description'] = description
-    calendar_service.events().insert(calendarId=GOOGLE_CALENDAR_ID, body=event).execute()
-
-def get_events_between(start_dt, end_dt):
-    result = calendar_service.events().list(
+    execute_request(calendar_service.events().insert(calendarId=GOOGLE_CALENDAR_ID, body=event))
+    clear_events_cache()
+
+def get_events_between(start_dt, end_dt, use_cache=True):
+    key = (start_dt.isoformat(), end_dt.isoformat())
+    with _events_cache_lock:
+        cached = _events_cache.get(key) if use_cache else None
+        generation = _events_cache_generation
+    if cached is not None:
+        return list(cached)
+
+    result = execute_request(calendar_service.events().list(
         calendarId=GOOGLE_CALENDAR_ID,
-        timeMin=start_dt.isoformat(),
-        timeMax=end_dt.isoformat(),
+        timeMin=key[0],
+        timeMax=key[1],
         singleEvents=True,
         orderBy='startTime'
-    ).execute()
-    return result.get('items', [])
+    ))
+    items = tuple(result.get('items', []))
+    with _events_cache_lock:
+        if generation == _events_cache_generation:
+            _events_cache[key] = items
+    return list(items)
+
+# 削除コマンドの項目名 → data のキー
+_DELETE_KEYS = {
+    'タイトル': 'title',
+    '日付': 'date',
+    '開始時間': 'start_time',
+    '内容': 'content',
+    'URL': 'url',
+}
 
 def parse_delete_message(message):
-    content = message.replace("【削除】", "").strip()
-    lines = [line.strip() for line in content.splitlines() if line.strip()]
-
-    data = {}
-    for line in lines:
-        if line.startswith("【タイトル】"):
-            data['title'] = line.replace("【タイトル】", "").strip()
-        elif line.startswith("【日付】"):
-            data['date'] = line.replace("【日付】", "").strip()
-        elif line.startswith("【開始時間】"):
-            data['start_time'] = line.replace("【開始時間】", "").strip()
-        elif line.startswith("【内容】"):
-            data['content'] = line.replace("【内容】", "").strip()
-        elif line.startswith("【URL】"):
-            data['url'] = line.replace("【URL】", "").strip()
-    return data
+    return {
+        _DELETE_KEYS[m.group(1)]: m.group(2).strip()
+        for m in _FIELDS_RE.finditer(message)
+    }
+
+def index_events_by_title(events):
+    """タイトル → 予定 の辞書を作る（同じタイトルが複数あれば先頭を優先）"""
+    return {e['summary']: e for e in reversed(events) if 'summary' in e}
+
+# 削除コマンドの日付（7/10, 7-10）と開始時間（14:00, 14）
+_DELETE_DATE_RE = re.compile(r'^\s*(\d{1,2})\s*[/-]\s*(\d{1,2})\s*$')
+_DELETE_TIME_RE = re.compile(r'^\s*(\d{1,2})(?::(\d{1,2}))?\s*$')
 
 def delete_event_from_data(data):
     try:
-        year = datetime.now(JST).year
-        month, day = map(int, data['date'].split('/'))
-        time_part = data['start_time']
-        if ':' in time_part:
-            hour, minute = map(int, time_part.split(':'))
-        else:
-            hour = int(time_part)
-            minute = 0
-        start_dt = JST.localize(datetime(year, month, day, hour, minute))
+        year = current_year()
+        date_match = _DELETE_DATE_RE.match(data['date'])
+        if not date_match:
+            raise ValueError(f"日付を解釈できません: {data['date']}")
+        time_match = _DELETE_TIME_RE.match(data['start_time'])
+        if not time_match:
+            raise ValueError(f"開始時間を解釈できません: {data['start_time']}")
+        month, day = int(date_match[1]), int(date_match[2])
+        hour, minute = int(time_match[1]), int(time_match[2] or 0)
+        start_dt = datetime(year, month, day, hour, minute, tzinfo=JST)
         end_dt = start_dt + timedelta(hours=1)
     except Exception as e:
         return f"日時の形式が正しくありません。エラー: {e}"
 
-    events = get_events_between(start_dt, end_dt)
-    for event in events:
-        if event.get('summary') == data.get('title'):
-            calendar_service.events().delete(calendarId=GOOGLE_CALENDAR_ID, eventId=event['id']).execute()
-            return f"予定「{data.get('title')}」を削除しました。"
-    return "該当する予定が見つかりませんでした。"
+    # 削除対象の ID は古い一覧から選ばないよう、キャッシュを使わずに取得する
+    events_by_title = index_events_by_title(get_events_between(start_dt, end_dt, use_cache=False))
+    event = events_by_title.get(data.get('title'))
+    if event is None:
+        return "該当する予定が見つかりませんでした。"
+    execute_request(calendar_service.events().delete(calendarId=GOOGLE_CALENDAR_ID, eventId=event['id']))
+    clear_events_cache()
+    return f"予定「{data.get('title')}」を削除しました。"
+
+# Calendar への書き込み用のバックグラウンドワーカー
+_calendar_executor = ThreadPoolExecutor(max_workers=4)
+
+def _log_calendar_errors(future):
+    exc = future.exception()
+    if exc is not None:
+        app.logger.error("Google Calendar への書き込みに失敗しました: %s", exc, exc_info=exc)
 
 def handle_incoming_message(message_text):
     if message_text.startswith("【削除】"):
@@ -132,7 +283,10 @@ def handle_incoming_message(message_text):
             return "削除コマンドの形式が不完全です。タイトル、日付、開始時間を必ず指定してください。"
         return delete_event_from_data(data)
 
-    if "【タイトル】" not in message_text or "【日付】" not in message_text or "【開始時間】" not in message_text:
+    # ほとんどの雑談はタイトル指定を含まないので、まずそれだけで弾く
+    if "【タイトル】" not in message_text:
+        return None
+    if "【日付】" not in message_text or "【開始時間】" not in message_text:
         return None
 
     parsed = extract_event_info(message_text)
@@ -141,7 +295,9 @@ def handle_incoming_message(message_text):
                 "【タイトル】会議\n【日付】7/10\n【開始時間】14:00\n【内容】説明\n【URL】https://...")
 
     title, start_str, end_str, description = parsed
-    add_event(title, start_str, end_str, description=description)
+    # Calendar への書き込みは待たずに LINE へ応答する
+    future = _calendar_executor.submit(add_event, title, start_str, end_str, description)
+    future.add_done_callback(_log_calendar_errors)
     return f"予定を登録しました：{title}（{start_str}）"
 
 @handler.add(MessageEvent, message=TextMessage)
@@ -150,38 +306,65 @@ def handle_message(event):
     if reply:
         line_bot_api.reply_message(event.reply_token, TextSendMessage(text=reply))
 
+# 通知メッセージの定型文
+_HDR_WEEK = "【今週の予定】"
+_HDR_TOMORROW = "【明日の予定】"
+_EMPTY_BODY = "\n予定はありません。"
+_TRAILER = "\nご参加ご希望の方は予定表に調整さんがあればそちらから出欠のご連絡をお願いします。"
+
+def event_start_time(event):
+    # 終日予定は dateTime を持たないので空欄にする
+    try:
+        return event['start']['dateTime'][11:16]
+    except KeyError:
+        return ''
+
 def format_events(events, header):
     if not events:
-        return header + "\n予定はありません。"
-    lines = [header]
-    for e in events:
-        start = e['start'].get('dateTime', '')[11:16]
-        lines.append(f"{start} - {e['summary']}")
-    lines.append("\nご参加ご希望の方は予定表に調整さんがあればそちらから出欠のご連絡をお願いします。")
-    return '\n'.join(lines)
+        return header + _EMPTY_BODY
+    return '\n'.join(chain(
+        (header,),
+        (f"{event_start_time(e)} - {e['summary']}" for e in events),
+        (_TRAILER,)
+    ))
 
 def notify_week_events(bot):
     today = datetime.now(JST)
-    start = JST.localize(datetime(today.year, today.month, today.day, 0, 0, 0))
-    end_date = today + timedelta(days=6 - today.weekday())
-    end = JST.localize(datetime(end_date.year, end_date.month, end_date.day, 23, 59, 59))
+    start = today.replace(hour=0, minute=0, second=0, microsecond=0)
+    end = (start + timedelta(days=6 - today.weekday())).replace(hour=23, minute=59, second=59)
     events = get_events_between(start, end)
-    msg = format_events(events, "【今週の予定】")
+    msg = format_events(events, _HDR_WEEK)
     bot.push_message(LINE_GROUP_ID, TextSendMessage(text=msg))
 
 def notify_tomorrow_events(bot):
     tomorrow = datetime.now(JST) + timedelta(days=1)
-    start = JST.localize(datetime(tomorrow.year, tomorrow.month, tomorrow.day))
+    start = tomorrow.replace(hour=0, minute=0, second=0, microsecond=0)
     end = start + timedelta(days=1)
     events = get_events_between(start, end)
-    msg = format_events(events, "【明日の予定】")
+    msg = format_events(events, _HDR_TOMORROW)
     bot.push_message(LINE_GROUP_ID, TextSendMessage(text=msg))
 
+# 同じホスト上でスケジューラが複数起動しないようにするためのロック
+SCHEDULER_LOCK_PATH = '/tmp/event_bot_sched.lock'
+_scheduler_lock_file = None
+
 def start_scheduler(line_bot_api):
+    global _scheduler_lock_file
+    lock_file = open(SCHEDULER_LOCK_PATH, 'w')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        # 他のプロセスがすでにスケジューラを動かしている
+        lock_file.close()
+        return False
+    # プロセスが生きている間はロックを保持する
+    _scheduler_lock_file = lock_file
+
     scheduler = BackgroundScheduler(timezone=JST)
     scheduler.add_job(lambda: notify_week_events(line_bot_api), 'cron', day_of_week='mon', hour=8)
     scheduler.add_job(lambda: notify_tomorrow_events(line_bot_api), 'cron', hour=20)
     scheduler.start()
+    return True
 
 @app.route("/")
 def index():
@@ -190,7 +373,10 @@ def index():
 @app.route("/callback", methods=["POST"])
 def callback():
     signature = request.headers.get("X-Line-Signature")
-    body = request.get_data(as_text=True)
+    if signature is None:
+        abort(400)
+    # 署名検証も JSON の読み込みも bytes のまま行える
+    body = request.get_data()
     try:
         handler.handle(body, signature)
     except InvalidSignatureError:
@@ -219,7 +405,10 @@ def test_notify_tomorrow_route():
     notify_tomorrow_events(line_bot_api)
     return "Test tomorrow reminder sent!"
 
+# Web は gunicorn（Procfile の web）で起動する。
+# このファイルを直接実行した場合は定期通知のスケジューラだけを動かす（Procfile の clock）。
 if __name__ == "__main__":
-    start_scheduler(line_bot_api)
-    port = int(os.environ.get("PORT", 5000))
-    app.run(host="0.0.0.0", port=port)
\ No newline at end of file
+    if not start_scheduler(line_bot_api):
+        raise SystemExit("スケジューラは別のプロセスで起動済みです。")
+    while True:
+        time.sleep(3600)